@@ -1,15 +1,186 @@
 import subprocess
 import re
+import socket
+import select
+import threading
 import time
 import platform
 import os
 from typing import Optional, Tuple
 
+DEVICES_CACHE_TTL = 2.0  # adb devices 结果的缓存时间（秒）
+ADB_SERVER_ADDRESS = ('127.0.0.1', 5037)
+_IP_RE = re.compile(r'src (\d+\.\d+\.\d+\.\d+)')
+SHELL_END_MARKER = '__END__'
+
+def _wrap_shell_command(command: str) -> str:
+    """合并 stderr 并在输出末尾追加结束标记及退出码，用于从 shell 输出中取回退出状态"""
+    return f"{{ {command}\n}} 2>&1; echo \"{SHELL_END_MARKER} $?\""
+
+class ADBServerError(Exception):
+    """adb server 返回 FAIL"""
+
+class ADBServerUnavailable(Exception):
+    """无法连接到 adb server（未运行），此时请求尚未发出，可安全回退到 adb 命令行"""
+
+class ADBServerClient:
+    """通过 TCP 直接与 adb server 通信，省去每条命令 fork adb 进程的开销
+
+    协议：请求为 4 位十六进制长度 + 服务名，应答以 OKAY/FAIL 开头。
+    adb server 未运行时连接失败会抛出 ADBServerUnavailable，由调用方回退到 adb 命令行；
+    请求发出后的读写错误照常抛出 OSError，不能再回退，否则同一命令会执行两次。
+    timeout 只用于建立连接；host:connect: 等请求本身可能远超 5 秒，读取时不设超时。
+    """
+
+    def __init__(self, address=ADB_SERVER_ADDRESS, timeout=5.0):
+        self.address = address
+        self.timeout = timeout
+
+    def _connect(self) -> socket.socket:
+        try:
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+        except OSError as e:
+            raise ADBServerUnavailable(str(e)) from e
+        sock.settimeout(None)
+        return sock
+
+    def _send(self, sock: socket.socket, service: str):
+        payload = service.encode('utf-8')
+        sock.sendall(b'%04x' % len(payload) + payload)
+
+    def _recv_exact(self, sock: socket.socket, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("adb server closed connection")
+            data += chunk
+        return bytes(data)
+
+    def _recv_all(self, sock: socket.socket) -> bytes:
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def _fail(self, reason: bytes, service: str, device_id: Optional[str]) -> ADBServerError:
+        message = reason.decode('utf-8', 'replace')
+        if not message:
+            # forward/killforward 失败时 adb server 只回 FAIL0000，补上请求与设备便于排查
+            device = f"device {device_id}" if device_id else "default device"
+            message = f"{service} failed on {device}: no reason from adb server (device not found or offline?)"
+        return ADBServerError(message)
+
+    def _read_status(self, sock: socket.socket, service: str, device_id: Optional[str] = None):
+        status = self._recv_exact(sock, 4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            length = int(self._recv_exact(sock, 4), 16)
+            raise self._fail(self._recv_exact(sock, length), service, device_id)
+        raise ADBServerError(f"unexpected adb server response: {status!r}")
+
+    def host(self, service: str, device_id: Optional[str] = None) -> str:
+        """发送 host 服务请求（host:devices、host-serial:<id>:get-state 等），device_id 仅用于错误信息"""
+        with self._connect() as sock:
+            self._send(sock, service)
+            self._read_status(sock, service, device_id)
+            rest = self._recv_all(sock)
+        # forward 等请求会在设备选择后再回一个状态
+        if rest.startswith(b'OKAY'):
+            rest = rest[4:]
+        elif rest.startswith(b'FAIL'):
+            raise self._fail(rest[8:], service, device_id)
+        # 带长度前缀的应答
+        if len(rest) >= 4:
+            try:
+                length = int(rest[:4], 16)
+            except ValueError:
+                length = -1
+            if length == len(rest) - 4:
+                rest = rest[4:]
+        return rest.decode('utf-8', 'replace')
+
+    def open_transport(self, device_id: Optional[str], service: str) -> socket.socket:
+        """切换到设备传输并打开服务，返回已连接的套接字，由调用方负责关闭"""
+        sock = self._connect()
+        try:
+            transport = f"host:transport:{device_id}" if device_id else "host:transport-any"
+            self._send(sock, transport)
+            self._read_status(sock, transport, device_id)
+            self._send(sock, service)
+            self._read_status(sock, service, device_id)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def transport(self, device_id: Optional[str], service: str) -> str:
+        """切换到设备传输后发送服务请求（shell:、tcpip: 等），读取全部输出"""
+        with self.open_transport(device_id, service) as sock:
+            return self._recv_all(sock).decode('utf-8', 'replace')
+
+class ADBShellSession:
+    """通过 exec:sh 保持一个常驻的设备 shell，每条命令后输出结束标记及退出码来分隔结果"""
+
+    def __init__(self, client: ADBServerClient, device_id: Optional[str]):
+        self.sock = client.open_transport(device_id, 'exec:sh')
+        self._buffer = b''
+
+    def is_closed(self) -> bool:
+        """对端已关闭时返回 True（adbd 重启、设备重新插拔等）
+
+        对已关闭的 TCP 对端 sendall 仍会成功，要到读取时才发现 EOF，因此在发送前检查。
+        """
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return bool(readable) and not self.sock.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            return True
+
+    def send(self, command: str):
+        self.sock.sendall((_wrap_shell_command(command) + '\n').encode('utf-8'))
+
+    def read_result(self) -> Tuple[int, str]:
+        """读取到结束标记为止，返回 (returncode, output)"""
+        marker = SHELL_END_MARKER.encode('utf-8') + b' '
+        while True:
+            pos = self._buffer.find(marker)
+            if pos >= 0:
+                end = self._buffer.find(b'\n', pos)
+                if end >= 0:
+                    break
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("adb shell session closed")
+            self._buffer += chunk
+        output = self._buffer[:pos].decode('utf-8', 'replace')
+        returncode = int(self._buffer[pos + len(marker):end])
+        self._buffer = self._buffer[end + 1:]
+        return returncode, output
+
+    def run(self, command: str) -> Tuple[int, str]:
+        self.send(command)
+        return self.read_result()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
 class ADBManager:
     def __init__(self):
         self.adb_path = self._get_adb_path()
+        self.server_client = ADBServerClient()
         self.current_device = None
         self.is_tcp_mode = False
+        self._devices_cache = None
+        self._devices_ts = 0.0
+        self._shell_sessions = {}  # device_id -> ADBShellSession
+        self._shell_lock = threading.Lock()
 
     def _get_adb_path(self) -> str:
         """获取adb路径"""
@@ -27,8 +198,46 @@ class ADBManager:
         
         return adb_path
 
+    def _run_server_command(self, command: list, device_id: str = None) -> Optional[Tuple[bool, str]]:
+        """将常用命令转换为 adb server 协议请求，返回 (success, output)；不支持的命令返回 None"""
+        host_prefix = f"host-serial:{device_id}:" if device_id else "host:"
+        name, args = command[0], command[1:]
+        if name == 'devices' and not args:
+            return True, "List of devices attached\n" + self.server_client.host('host:devices')
+        if name == 'connect' and len(args) == 1:
+            return True, self.server_client.host(f"host:connect:{args[0]}")
+        if name == 'disconnect' and len(args) <= 1:
+            return True, self.server_client.host(f"host:disconnect:{args[0] if args else ''}")
+        if name == 'get-state' and not args:
+            return True, self.server_client.host(f"{host_prefix}get-state", device_id)
+        if name == 'forward' and len(args) == 2:
+            if args[0] == '--remove':
+                return True, self.server_client.host(f"{host_prefix}killforward:{args[1]}", device_id)
+            return True, self.server_client.host(f"{host_prefix}forward:{args[0]};{args[1]}", device_id)
+        if name == 'shell' and args:
+            # shell: 服务（v1 协议）不返回退出码，借助结束标记取回
+            output = self.server_client.transport(
+                device_id, 'shell:' + _wrap_shell_command(' '.join(args)))
+            marker = SHELL_END_MARKER + ' '
+            pos = output.rfind(marker)
+            if pos < 0:
+                return False, output
+            return output[pos + len(marker):].strip() == '0', output[:pos]
+        if name == 'tcpip' and len(args) == 1:
+            return True, self.server_client.transport(device_id, f"tcpip:{args[0]}")
+        return None
+
     def _run_adb_command(self, command: list, device_id: str = None) -> Tuple[bool, str]:
-        """运行adb命令并返回结果"""
+        """运行adb命令并返回结果，优先直连 adb server，失败时回退到 adb 命令行"""
+        try:
+            result = self._run_server_command(command, device_id)
+            if result is not None:
+                return result
+        except ADBServerUnavailable:
+            pass  # adb server 未运行，由 adb 命令行负责启动
+        except (ADBServerError, OSError) as e:
+            return False, str(e)
+
         try:
             cmd = [self.adb_path]
             if device_id:
@@ -45,8 +254,15 @@ class ADBManager:
         except Exception as e:
             return False, str(e)
 
+    def invalidate_devices_cache(self):
+        """设备连接状态变化后清除 get_devices 的缓存"""
+        self._devices_cache = None
+
     def get_devices(self) -> list:
-        """获取已连接的设备列表"""
+        """获取已连接的设备列表（短时间内重复调用返回缓存结果）"""
+        if self._devices_cache is not None and time.monotonic() - self._devices_ts < DEVICES_CACHE_TTL:
+            return list(self._devices_cache)
+
         success, output = self._run_adb_command(['devices'])
         if not success:
             return []
@@ -61,17 +277,56 @@ class ADBManager:
                         'state': parts[1],
                         'is_tcp': ':' in parts[0]
                     })
-        return devices
+        self._devices_cache = devices
+        self._devices_ts = time.monotonic()
+        return list(devices)
+
+    def _drop_shell_session(self, device_id: Optional[str]):
+        session = self._shell_sessions.pop(device_id, None)
+        if session is not None:
+            session.close()
+
+    def _shell(self, command: str, device_id: str = None) -> Tuple[bool, str]:
+        """在常驻 shell 会话中执行命令；会话无法打开或命令未能发出时回退到单次 adb shell"""
+        with self._shell_lock:
+            session = self._shell_sessions.get(device_id)
+            if session is not None and session.is_closed():
+                self._drop_shell_session(device_id)
+                session = None
+            try:
+                if session is None:
+                    session = ADBShellSession(self.server_client, device_id)
+                    self._shell_sessions[device_id] = session
+                session.send(command)
+            except ADBServerError as e:
+                return False, str(e)
+            except (ADBServerUnavailable, OSError):
+                # 会话已断开或 adb server 未运行，命令尚未发出，丢弃会话后回退
+                self._drop_shell_session(device_id)
+            else:
+                try:
+                    returncode, output = session.read_result()
+                    return returncode == 0, output
+                except (OSError, ValueError) as e:
+                    # 命令已发出，可能已在设备上执行，不再重试
+                    self._drop_shell_session(device_id)
+                    return False, str(e)
+        return self._run_adb_command(['shell', command], device_id)
+
+    def close_shell_sessions(self):
+        with self._shell_lock:
+            for session in self._shell_sessions.values():
+                session.close()
+            self._shell_sessions.clear()
 
     def get_device_ip(self) -> Optional[str]:
         """获取设备IP地址"""
-        success, output = self._run_adb_command(['shell', 'ip', 'route'])
+        success, output = self._shell('ip route')
         if not success:
             return None
 
         # 查找wlan0接口的IP地址
-        pattern = r'src (\d+\.\d+\.\d+\.\d+)'
-        match = re.search(pattern, output)
+        match = _IP_RE.search(output)
         if match:
             return match.group(1)
         return None
@@ -80,6 +335,8 @@ class ADBManager:
         """通过TCP/IP连接设备，返回 (success, output)"""
         address = f"{ip}:{port}"
         success, output = self._run_adb_command(['connect', address])
+        self.invalidate_devices_cache()
+        self.close_shell_sessions()
         out_lower = (output or '').lower()
         if success and ('connected' in out_lower or 'already connected' in out_lower):
             self.current_device = address
@@ -94,7 +351,9 @@ class ADBManager:
             success, _ = self._run_adb_command(['disconnect', address])
         else:
             success, _ = self._run_adb_command(['disconnect'])
-        
+        self.invalidate_devices_cache()
+        self.close_shell_sessions()
+
         if success:
             self.current_device = None
             self.is_tcp_mode = False
@@ -115,6 +374,8 @@ class ADBManager:
 
         # 启用TCP/IP模式
         success, output = self._run_adb_command(['tcpip', '5555'])
+        self.invalidate_devices_cache()
+        self.close_shell_sessions()  # tcpip 会重启 adbd，已有的 exec:sh 会话随之失效
         if not success:
             return False, f"启用TCP/IP模式失败: {output}"
 
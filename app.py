@@ -1,24 +1,42 @@
+import os
+
+# eventlet 需在其他模块导入前完成 monkey_patch。Windows 下 eventlet 无法协作式读取子进程管道，
+# scrcpy 服务端日志的阻塞读取会卡住整个事件循环，因此保留线程模式
+eventlet = None
+if os.name != 'nt':
+    try:
+        import eventlet
+        eventlet.monkey_patch()
+    except ImportError:
+        eventlet = None
+
 from flask import Flask, render_template, request
 from flask_socketio import SocketIO, emit, send
 from scrcpy import Scrcpy
 from adb_manager import ADBManager
 import argparse
+import logging
 import queue
 import atexit
-import os
 from dotenv import load_dotenv
 import sys
 from contextlib import redirect_stdout, redirect_stderr
 import threading
+import socket
 import base64
 from pathlib import Path
 import re
 
+# 继承 scrcpy 日志器的级别（环境变量 SCRCPY_LOG）
+log = logging.getLogger('scrcpy.app')
+
 # 设备管理器
 class DeviceManager:
     def __init__(self):
         self.devices = {}  # 存储所有连接的设备
         self.adb_manager = ADBManager()
+        self._pending_update = False  # 是否已安排推送设备列表变更
+        self._last_snapshot = {}  # 最近一次推送给客户端的设备列表
 
     def add_device(self, device_id, state="device"):
         # 检查设备是否已存在
@@ -68,18 +86,38 @@ class DeviceManager:
             for d in self.devices.values()
         ]
 
+    def snapshot_device_list(self):
+        """返回完整设备列表，并以此作为后续差异计算的基准"""
+        devices = self.get_device_list()
+        self._last_snapshot = {d["id"]: d for d in devices}
+        return devices
+
+    def diff_device_list(self):
+        """返回自上次推送以来的变更 {added, removed, changed}，无变更时返回 None"""
+        current = {d["id"]: d for d in self.get_device_list()}
+        last = self._last_snapshot
+        self._last_snapshot = current
+        diff = {
+            "added": [d for did, d in current.items() if did not in last],
+            "removed": [did for did in last if did not in current],
+            "changed": [d for did, d in current.items() if did in last and last[did] != d],
+        }
+        if not (diff["added"] or diff["removed"] or diff["changed"]):
+            return None
+        return diff
+
     def cleanup(self):
         for device_id in list(self.devices.keys()):
             self.remove_device(device_id)
         self.adb_manager.disconnect_device()
 
 client_sid = None
-message_queue = queue.Queue()
 video_bit_rate = "1024000"
 device_manager = DeviceManager()
 
 # 注册退出时的清理函数
 def cleanup_on_exit():
+    stop_video_send_task()
     device_manager.cleanup()
 
 atexit.register(cleanup_on_exit)
@@ -92,31 +130,251 @@ AGENT_MODEL = os.getenv('AGENT_MODEL')
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
-# 显式使用线程模式，避免不必要的依赖探测带来的启动开销
-socketio = SocketIO(app, async_mode='threading')
+# 显式指定异步模式，避免不必要的依赖探测带来的启动开销：可用时使用 eventlet，否则使用线程模式
+socketio = SocketIO(app, async_mode='eventlet' if eventlet else 'threading', max_http_buffer_size=1_000_000)
+
+class SPSCRing:
+    """单生产者/单消费者环形缓冲区，提供 put/get 等与 queue.Queue 相同的接口
+
+    读写下标各自只由一方修改，依赖 GIL 保证可见性，快速路径不获取锁；
+    仅在对方可能处于等待状态时才通过 Event 唤醒。
+    close 后 put 直接丢弃数据，get 取完剩余数据后返回 None，双方都不会再阻塞。
+    """
+
+    def __init__(self, maxsize=64, not_empty=None, not_full=None):
+        size = 1 << (maxsize - 1).bit_length()
+        self._slots = [None] * size
+        self._mask = size - 1
+        self._write = 0
+        self._read = 0
+        self._closed = False
+        self._not_empty = not_empty if not_empty is not None else threading.Event()
+        self._not_full = not_full if not_full is not None else threading.Event()
+
+    def qsize(self):
+        return self._write - self._read
+
+    def full(self):
+        return self._write - self._read > self._mask
+
+    def close(self):
+        """停止时调用，唤醒阻塞在 put/get 中的一方"""
+        self._closed = True
+        self._not_full.set()
+        self._not_empty.set()
+
+    def put_nowait(self, item):
+        if self._closed:
+            return
+        write = self._write
+        if write - self._read > self._mask:
+            raise queue.Full
+        self._slots[write & self._mask] = item
+        self._write = write + 1
+        if not self._not_empty.is_set():
+            self._not_empty.set()
+
+    def put(self, item):
+        while True:
+            try:
+                return self.put_nowait(item)
+            except queue.Full:
+                self._not_full.clear()
+                # 清除后再检查一次，避免错过消费者在此期间的唤醒
+                if self.full() and not self._closed:
+                    self._not_full.wait()
+
+    def get_nowait(self):
+        read = self._read
+        if read == self._write:
+            raise queue.Empty
+        index = read & self._mask
+        item = self._slots[index]
+        self._slots[index] = None
+        self._read = read + 1
+        if not self._not_full.is_set():
+            self._not_full.set()
+        return item
+
+    def get(self):
+        while True:
+            try:
+                return self.get_nowait()
+            except queue.Empty:
+                if self._closed:
+                    return None
+                self._not_empty.clear()
+                if self._read == self._write and not self._closed:
+                    self._not_empty.wait()
+
+class HubWakeEvent:
+    """可在任意系统线程中 set、在 eventlet 绿色线程中 wait 的事件
+
+    eventlet 的队列与 hub 调度都不是线程安全的，跨线程调用也无法唤醒正在等待 IO 的 hub；
+    这里与 eventlet.tpool 一样通过 socketpair 写入一个字节来唤醒。
+    写端为原始套接字，系统线程中 send 不会触及 hub；只有读端包装为绿色套接字。
+    """
+
+    def __init__(self):
+        from eventlet.greenio import GreenSocket
+        from eventlet.patcher import original
+        self._flag = False
+        rsock, self._wsock = original('socket').socketpair()
+        self._rsock = GreenSocket(rsock)
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        if not self._flag:
+            self._flag = True
+            self._wsock.send(b'\0')
+
+    def clear(self):
+        self._flag = False
+
+    def wait(self):
+        # 可能因之前残留的字节提前返回，调用方会重新检查条件
+        if not self._flag:
+            self._rsock.recv(64)
+
+def create_message_queue(maxsize=64):
+    """按 Socket.IO 的异步模式选择队列，生产者入队即可直接唤醒发送任务，无需轮询"""
+    if socketio.async_mode == 'eventlet':
+        # scrcpy 读取线程为真实的系统线程：消费者在 hub 中等待 socketpair，生产者队列满时在系统线程中等待
+        from eventlet.patcher import original
+        return SPSCRing(maxsize=maxsize, not_empty=HubWakeEvent(), not_full=original('threading').Event())
+    # 线程模式下只有一个生产者（scrcpy 读取线程）和一个消费者（video_send_task），用无锁环形缓冲区
+    return SPSCRing(maxsize=maxsize)
+
+# 每次镜像使用独立的队列，停止时置为 None，旧的发送任务据此丢弃残留数据并退出
+message_queue = None
+VIDEO_QUEUE_HIGH_WATERMARK = 48  # 队列积压超过该值时丢弃非关键块，直到下一个关键帧
+dropping_video = False
+# 读取线程累计请求关键帧的次数；eventlet 下它是系统线程，不能使用 logging（锁已被替换为绿色）
+# 或绿色套接字，由 video_send_task 比较该计数后负责记录日志并发送 RESET_VIDEO
+keyframe_requests = 0
+VIDEO_BATCH_MAX_COUNT = 16  # 每次 emit 最多合并的块数
+VIDEO_BATCH_MAX_BYTES = 512 * 1024  # 每次 emit 合并的字节数上限
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
-def video_send_task():
-    global client_sid
-    while client_sid is not None:
+def video_send_task(video_queue):
+    handled_keyframe_requests = 0
+    while True:
+        # 阻塞等待，直到有新数据或队列关闭返回 None
+        message = video_queue.get()
+        if message is None or video_queue is not message_queue:
+            break
+        # 丢帧时队列必然积压，发送任务总会在下一次取数据时看到新的请求
+        if keyframe_requests != handled_keyframe_requests:
+            handled_keyframe_requests = keyframe_requests
+            log.warning("Client is falling behind, dropping video until next keyframe")
+            request_keyframe()
+        # 一次唤醒尽量取完积压的数据，合并为一次 emit，减少 WebSocket 帧数
+        batch = [message]
+        batch_size = len(message)
+        while len(batch) < VIDEO_BATCH_MAX_COUNT and batch_size < VIDEO_BATCH_MAX_BYTES:
+            try:
+                message = video_queue.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                break
+            batch.append(message)
+            batch_size += len(message)
+        if video_queue is not message_queue:  # 镜像已停止，丢弃残留数据
+            break
+        sid = client_sid
+        if sid is None:  # 客户端已断开，继续消费以免阻塞生产者
+            continue
         try:
-            message = message_queue.get(timeout=0.01)
-            if client_sid:  # 确保客户端仍然连接
-                socketio.emit('video_data', message, to=client_sid)
-        except queue.Empty:
-            pass
+            # 各块均以数据包边界结束，直接拼接仍是合法的流；bytes 会作为二进制附件发送，无需 JSON/base64 编码
+            socketio.emit('video_data', batch[0] if len(batch) == 1 else b''.join(batch), to=sid)
         except Exception as e:
-            print(f"Error sending data: {e}")
-        finally:
-            socketio.sleep(0.001)
+            log.warning("Error sending data: %s", e)
     print(f"video_send_task stopped")
 
-def send_video_data(data):
-    if not message_queue.full():
-        message_queue.put(data)
+def start_video_send_task():
+    """为新的镜像创建队列，需在 scrcpy 开始回调数据之前调用"""
+    global message_queue, dropping_video, keyframe_requests
+    dropping_video = False
+    keyframe_requests = 0
+    message_queue = create_message_queue()
+    return message_queue
+
+def discard_video_send_task(video_queue, previous_queue):
+    """镜像启动失败时关闭新建的队列，并恢复之前的队列，避免其发送任务失去关闭的途径"""
+    global message_queue
+    video_queue.close()
+    if message_queue is video_queue:
+        message_queue = previous_queue
+
+def stop_video_send_task():
+    """使当前队列失效并关闭，让 video_send_task 退出；阻塞在 put 中的 scrcpy 读取线程也随之返回"""
+    global message_queue, dropping_video
+    video_queue, message_queue = message_queue, None
+    dropping_video = False
+    if video_queue is not None:
+        video_queue.close()
+
+def stop_device_mirror(device_id):
+    """停止设备镜像；须先关闭视频队列，否则 scrcpy_stop 等待的读取线程可能卡在队列满的 put 上"""
+    device = device_manager.devices.get(device_id)
+    if not device or not device["is_mirroring"]:
+        return False
+    stop_video_send_task()
+    return device_manager.stop_mirror(device_id)
+
+def request_keyframe():
+    device_id = get_current_mirroring_device_id()
+    if device_id:
+        scpy = device_manager.devices[device_id]["scrcpy"]
+        if scpy:
+            scpy.scrcpy_reset_video()
+
+def send_video_data(data, is_keyframe):
+    """在 scrcpy 读取线程中调用，只操作队列与计数"""
+    global dropping_video, keyframe_requests
+    video_queue = message_queue
+    if video_queue is None:
+        return
+    if dropping_video:
+        # 客户端跟不上时整组丢弃，直到下一个关键帧，避免把残缺的 GOP 发给解码器
+        if not is_keyframe:
+            return
+        dropping_video = False
+    elif not is_keyframe and video_queue.qsize() > VIDEO_QUEUE_HIGH_WATERMARK:
+        dropping_video = True
+        keyframe_requests += 1
+        return
+    if is_keyframe:
+        # 关键块不能丢，队列满时阻塞等待发送任务消费
+        video_queue.put(data)
+    else:
+        try:
+            video_queue.put_nowait(data)
+        except queue.Full:
+            dropping_video = True
+            keyframe_requests += 1
+
+DEVICE_UPDATE_DELAY = 0.01  # 合并短时间内的多次设备列表变更
+
+def flush_device_list_update():
+    socketio.sleep(DEVICE_UPDATE_DELAY)
+    device_manager._pending_update = False
+    diff = device_manager.diff_device_list()
+    sid = client_sid
+    if diff and sid:
+        socketio.emit('device_list_diff', diff, to=sid)
+
+def schedule_device_list_update():
+    """标记设备列表已变更，稍后只推送差异"""
+    if not device_manager._pending_update:
+        device_manager._pending_update = True
+        socketio.start_background_task(flush_device_list_update)
 
 @socketio.on('connect')
 def handle_connect():
@@ -124,7 +382,7 @@ def handle_connect():
     print('Client connected')
     client_sid = request.sid
     # 发送当前设备列表
-    emit('device_list_update', device_manager.get_device_list())
+    emit('device_list_update', device_manager.snapshot_device_list())
     return True
 
 def get_current_mirroring_device_id():
@@ -411,7 +669,7 @@ def handle_device_connect(data):
         success, output = device_manager.adb_manager.connect_to_device(ip, port)
         if success:
             if device_manager.add_device(device_id):
-                emit('device_list_update', device_manager.get_device_list())
+                schedule_device_list_update()
                 print(f'Device connected successfully: {device_id}')
             else:
                 device_manager.adb_manager.disconnect_device(ip, port)
@@ -427,39 +685,48 @@ def handle_device_connect(data):
 def handle_device_disconnect(data):
     device_id = data.get('device_id')
     if device_id in device_manager.devices:
+        stop_device_mirror(device_id)
         device_manager.remove_device(device_id)
         device_manager.adb_manager.disconnect_device(
             *device_id.split(':') if ':' in device_id else (device_id, None)
         )
-        emit('device_list_update', device_manager.get_device_list())
+        schedule_device_list_update()
         print(f'Device disconnected: {device_id}')
 
 @socketio.on('start_mirror')
 def handle_start_mirror(data):
     device_id = data.get('device_id')
+    # 未知设备或重复点击时直接拒绝，不能替换正在镜像的设备的队列
+    device = device_manager.devices.get(device_id)
+    if not device or device["is_mirroring"]:
+        emit('mirror_error', '启动镜像失败')
+        return
     # 若已有其他设备在镜像，先关闭它们
     try:
         for did, info in list(device_manager.devices.items()):
             if info["is_mirroring"] and did != device_id:
-                device_manager.stop_mirror(did)
+                stop_device_mirror(did)
                 emit('mirror_stopped', {'device_id': did})
         # 更新设备列表（状态变更）
-        emit('device_list_update', device_manager.get_device_list())
+        schedule_device_list_update()
     except Exception as e:
         print(f"Error stopping previous mirrors: {e}")
 
+    previous_queue = message_queue
+    video_queue = start_video_send_task()
     if device_manager.start_mirror(device_id, send_video_data):
-        socketio.start_background_task(video_send_task)
-        emit('device_list_update', device_manager.get_device_list())
+        socketio.start_background_task(video_send_task, video_queue)
+        schedule_device_list_update()
         emit('mirror_started', {'device_id': device_id})
     else:
+        discard_video_send_task(video_queue, previous_queue)
         emit('mirror_error', '启动镜像失败')
 
 @socketio.on('stop_mirror')
 def handle_stop_mirror(data):
     device_id = data.get('device_id')
-    if device_manager.stop_mirror(device_id):
-        emit('device_list_update', device_manager.get_device_list())
+    if stop_device_mirror(device_id):
+        schedule_device_list_update()
         emit('mirror_stopped', {'device_id': device_id})
     else:
         emit('mirror_error', '停止镜像失败')
@@ -471,13 +738,12 @@ def handle_disconnect():
     print('Client disconnected')
     # 停止所有正在镜像的设备
     for device_id in list(device_manager.devices.keys()):
-        if device_manager.devices[device_id]["is_mirroring"]:
-            device_manager.stop_mirror(device_id)
+        stop_device_mirror(device_id)
     print('Session cleaned up')
 
 @socketio.on('control_data')
 def handle_control_data(data):
-    print(f"Received control data: {data}")  # 添加调试信息
+    log.debug("Received control data: %s", data)
     device_id = data.get('device_id')
     if device_id and device_id in device_manager.devices:
         device_info = device_manager.devices[device_id]
@@ -485,19 +751,19 @@ def handle_control_data(data):
             try:
                 control_data = data.get('data')
                 if control_data:
-                    print(f"Sending control data to device {device_id}: {len(control_data)} bytes")  # 调试信息
+                    log.debug("Sending control data to device %s: %d bytes", device_id, len(control_data))
                     device_info["scrcpy"].scrcpy_send_control(control_data)
-                    print("Control data sent successfully")  # 调试信息
+                    log.debug("Control data sent successfully")
                 else:
-                    print("No control data found in request")  # 调试信息
+                    log.debug("No control data found in request")
             except Exception as e:
-                print(f"Error sending control data: {e}")
+                log.warning("Error sending control data: %s", e)
                 emit('control_error', f'发送控制数据失败: {e}')
         else:
-            print(f"Device {device_id} is not mirroring or scrcpy instance not found")  # 调试信息
+            log.debug("Device %s is not mirroring or scrcpy instance not found", device_id)
             emit('control_error', '设备未在镜像状态')
     else:
-        print(f"Device {device_id} not found in device manager")  # 调试信息
+        log.debug("Device %s not found in device manager", device_id)
         emit('control_error', '设备未找到')
 
 @socketio.on('ai_chat_message')
@@ -534,5 +800,6 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Web server for scrcpy')
     parser.add_argument('--video_bit_rate', default="1024000", help='scrcpy video bit rate')
     args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s: %(message)s')
     video_bit_rate = args.video_bit_rate
     socketio.run(app, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -1,53 +1,188 @@
 from threading import Thread
+import logging
+import os
 import subprocess
 import socket
+import tempfile
+import selectors
+import struct
+try:
+    from eventlet.patcher import is_monkey_patched, original
+except ImportError:
+    is_monkey_patched = None
 import time
 import random
 from adb_manager import ADBManager
 
+log = logging.getLogger('scrcpy')
+# 设置 SCRCPY_LOG=DEBUG 查看逐条调试日志；无法识别的级别按 WARNING 处理，避免导入时崩溃
+_log_level = logging.getLevelName(os.environ.get('SCRCPY_LOG', 'WARNING').upper())
+log.setLevel(_log_level if isinstance(_log_level, int) else logging.WARNING)
+
+# eventlet monkey_patch 后 Thread/selectors 为绿色实现，读取循环会与 emit 共用同一事件循环；
+# 改为在真实的系统线程中 select/recv，由 video_callback 负责跨线程唤醒发送任务。
+# 读取线程中不能使用 logging（处理器锁已被替换为绿色锁）或在绿色套接字上发送，只用 print 输出
+if is_monkey_patched and is_monkey_patched('thread'):
+    ReaderThread = original('threading').Thread
+
+    class ReaderSelector(selectors.SelectSelector):
+        # 绿色 select 只能在 hub 中等待，系统线程中使用原始的 select.select
+        _select = staticmethod(original('select').select)
+else:
+    ReaderThread = Thread
+    ReaderSelector = selectors.DefaultSelector
+
+def join_reader_thread(thread, timeout):
+    """等待读取线程结束；eventlet 下它是真实的系统线程，直接 join 会阻塞整个 hub，改为轮询并让出"""
+    if ReaderThread is Thread:
+        thread.join(timeout)
+        return
+    deadline = time.monotonic() + timeout
+    while thread.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.01)  # monkey_patch 后为绿色 sleep
+
 SCRCPY_SERVER_PATH = "scrcpy-server"
 DEVICE_SERVER_PATH = "/data/local/tmp/scrcpy-server.jar"
-BASE_PORT = 6666  # 改为基础端口，避免与5555冲突
+VIDEO_RECV_SIZE = 65536  # 单次 recv 的最大字节数
+VIDEO_BUFFER_SIZE = 1024 * 1024  # 视频接收缓冲区的初始大小
+VIDEO_FLUSH_SIZE = 32768  # 聚合达到该大小即回调
+VIDEO_FLUSH_INTERVAL = 0.008  # 首字节入缓冲后最多等待 8ms 再回调
+SOCKET_RCVBUF_SIZE = 4 * 1024 * 1024
+
+# scrcpy 视频流格式：设备名(64) + 编码信息(12)，之后每个数据包为 头(8字节 pts/flags + 4字节长度) + 负载
+DEVICE_NAME_SIZE = 64
+CODEC_META_SIZE = 12
+PACKET_HEADER = struct.Struct('>QI')
+PACKET_FLAG_CONFIG = 1 << 63
+PACKET_FLAG_KEY_FRAME = 1 << 62
+
+CONTROL_MSG_TYPE_RESET_VIDEO = 17
+
+class VideoCoalescer:
+    """按数据包边界聚合视频流，回调 callback(data, is_keyframe)
+
+    只回调完整的数据包；包含流头、配置包(SPS/PPS)或关键帧的块标记为关键块，
+    且关键块总是从新的一块开始，下游丢弃非关键块时不会破坏流的完整性。
+    套接字数据直接 recv_into 预分配的缓冲区，回调时只复制一次。
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self._allocate(VIDEO_BUFFER_SIZE)
+        self.length = 0  # buffer[:length] 为已接收的数据
+        self.ready = 0  # buffer[:ready] 为已解析完整、可回调的数据
+        self.ready_is_key = False
+        self.meta_left = DEVICE_NAME_SIZE + CODEC_META_SIZE
+        self.started_at = 0.0
+
+    def _allocate(self, size):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def recv_into(self, sock):
+        """从套接字读取数据到缓冲区末尾，返回读取的字节数（0 表示连接关闭）"""
+        if len(self.buffer) - self.length < VIDEO_RECV_SIZE:
+            # 单个数据包（如关键帧）超过缓冲区时扩容；存在内存视图时不能原地改变 bytearray 大小
+            old_view = self.view
+            self._allocate(len(self.buffer) * 2)
+            self.view[:self.length] = old_view[:self.length]
+            old_view.release()
+        n = sock.recv_into(self.view[self.length:], VIDEO_RECV_SIZE)
+        if n:
+            if not self.length:
+                self.started_at = time.monotonic()
+            self.length += n
+            self._parse()
+            if self.ready >= VIDEO_FLUSH_SIZE:
+                self.flush()
+        return n
+
+    def _parse(self):
+        if self.meta_left:
+            n = min(self.meta_left, self.length - self.ready)
+            self.ready += n
+            self.meta_left -= n
+            self.ready_is_key = True
+            if self.meta_left:
+                return
+        while self.length - self.ready >= PACKET_HEADER.size:
+            pts_flags, size = PACKET_HEADER.unpack_from(self.buffer, self.ready)
+            end = self.ready + PACKET_HEADER.size + size
+            if self.length < end:
+                break
+            is_key = bool(pts_flags & (PACKET_FLAG_CONFIG | PACKET_FLAG_KEY_FRAME))
+            if is_key and self.ready and not self.ready_is_key:
+                self.flush()
+                continue
+            self.ready = end
+            self.ready_is_key = self.ready_is_key or is_key
+
+    def timeout(self):
+        """距离必须回调的剩余秒数；没有可回调数据时返回 None"""
+        if not self.ready:
+            return None
+        return max(0.0, VIDEO_FLUSH_INTERVAL - (time.monotonic() - self.started_at))
+
+    def flush(self):
+        if not self.ready:
+            return
+        data = bytes(self.view[:self.ready])
+        is_key = self.ready_is_key
+        # 未完整的数据包移到缓冲区开头
+        rest = self.length - self.ready
+        if rest:
+            self.view[:rest] = self.view[self.ready:self.length]
+        self.length = rest
+        self.ready = 0
+        self.ready_is_key = False
+        self.started_at = time.monotonic()
+        self.callback(data, is_key)
 
 class Scrcpy:
     def __init__(self):
         self.video_socket = None
-        self.audio_socket = None
         self.control_socket = None
 
         self.android_thread = None
-        self.video_thread = None
-        self.audio_thread = None
-        self.control_thread = None
+        self.select_thread = None
+        self.selector = None
+        self.wakeup_sockets = None  # 用于在停止时唤醒 select_loop
+        self.video_coalescer = None
+        self.debug_control = False  # 读取线程中是否输出设备发来的控制消息
         self.android_process = None
         
         self.adb_manager = ADBManager()
         self.adb_path = self.adb_manager.adb_path
         self.device_id = None
         self.local_port = None  # 动态分配的本地端口
+        self.local_socket_path = None  # POSIX 下转发到的 Unix 域套接字路径
         
-    def find_available_port(self, start_port=BASE_PORT, max_attempts=100):
-        """查找可用的端口"""
-        for i in range(max_attempts):
-            port = start_port + i
-            try:
-                # 检查端口是否可用
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.bind(('127.0.0.1', port))
-                    return port
-            except OSError:
-                continue
-        raise Exception(f"无法找到可用端口，尝试了 {max_attempts} 个端口")
-        
+    def _local_forward_spec(self):
+        if self.local_socket_path:
+            return f"localfilesystem:{self.local_socket_path}"
+        return f"tcp:{self.local_port}"
+
+    def _remove_local_socket_file(self):
+        try:
+            os.unlink(self.local_socket_path)
+        except OSError:
+            pass
+
     def cleanup_adb_forward(self):
         """清理ADB端口转发"""
+        if self.local_socket_path:
+            try:
+                self.adb_manager._run_adb_command(["forward", "--remove", self._local_forward_spec()], self.device_id)
+                self._remove_local_socket_file()
+                print(f"Cleaned up ADB forward for {self.local_socket_path}")
+            except Exception as e:
+                print(f"Error cleaning up ADB forward: {e}")
+            finally:
+                self.local_socket_path = None
         if self.local_port:
             try:
-                cmd = [self.adb_path]
-                if self.device_id:
-                    cmd.extend(['-s', self.device_id])
-                cmd.extend(["forward", "--remove", f"tcp:{self.local_port}"])
-                subprocess.run(cmd, check=False)  # 不抛出异常，因为可能已经被清理
+                # 不检查结果，因为可能已经被清理
+                self.adb_manager._run_adb_command(["forward", "--remove", f"tcp:{self.local_port}"], self.device_id)
                 print(f"Cleaned up ADB forward for port {self.local_port}")
             except Exception as e:
                 print(f"Error cleaning up ADB forward: {e}")
@@ -70,17 +205,31 @@ class Scrcpy:
     def setup_adb_forward(self):
         # 首先清理可能存在的旧转发
         self.cleanup_adb_forward()
-        
-        # 分配新的可用端口
-        self.local_port = self.find_available_port()
-        print(f"Setting up ADB forward: tcp:{self.local_port} -> localabstract:scrcpy")
-        
-        cmd = [self.adb_path]
-        if self.device_id:
-            cmd.extend(['-s', self.device_id])
-        cmd.extend(["forward", f"tcp:{self.local_port}", "localabstract:scrcpy"])
-        
-        subprocess.run(cmd, check=True)
+
+        # POSIX 下优先转发到 Unix 域套接字，绕过本地回环 TCP 协议栈
+        if hasattr(socket, 'AF_UNIX') and os.name != 'nt':
+            self.local_socket_path = os.path.join(tempfile.gettempdir(), f"scrcpy-{os.getpid()}-{id(self):x}.sock")
+            self._remove_local_socket_file()
+            print(f"Setting up ADB forward: localfilesystem:{self.local_socket_path} -> localabstract:scrcpy")
+            success, output = self.adb_manager._run_adb_command(
+                ["forward", self._local_forward_spec(), "localabstract:scrcpy"], self.device_id
+            )
+            if success:
+                return
+            print(f"Unix socket forward failed, falling back to TCP: {output}")
+            self.local_socket_path = None
+
+        # tcp:0 由 adb 分配空闲端口并返回端口号
+        success, output = self.adb_manager._run_adb_command(
+            ["forward", "tcp:0", "localabstract:scrcpy"], self.device_id
+        )
+        if not success:
+            raise Exception(f"ADB forward failed: {output}")
+        try:
+            self.local_port = int(output.strip())
+        except ValueError:
+            raise Exception(f"ADB forward returned unexpected output: {output}")
+        print(f"ADB forward established: tcp:{self.local_port} -> localabstract:scrcpy")
 
     def start_server(self):
         print("Starting scrcpy server in background...")
@@ -89,7 +238,7 @@ class Scrcpy:
             cmd.extend(['-s', self.device_id])
         cmd.extend([
             "shell",
-            f"CLASSPATH={DEVICE_SERVER_PATH} app_process / com.genymobile.scrcpy.Server 3.1 tunnel_forward=true log_level=VERBOSE video_bit_rate=" + self.video_bit_rate
+            f"CLASSPATH={DEVICE_SERVER_PATH} app_process / com.genymobile.scrcpy.Server 3.1 tunnel_forward=true audio=false control=true log_level=VERBOSE video_bit_rate=" + self.video_bit_rate
         ])
         self.android_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         while not self.stop:
@@ -101,78 +250,108 @@ class Scrcpy:
         self.android_process.wait()
         print("Server stopped")
 
-    def receive_video_data(self):
-        print("Receiving video data (H.264)...")
+    def select_loop(self):
+        """单线程读取 video/control 两个连接，按 fd 分发给对应的处理函数"""
+        print("Select loop started")
+        # 映射中除唤醒套接字外仍有连接时继续
+        while not self.stop and len(self.selector.get_map()) > 1:
+            try:
+                events = self.selector.select(self.video_coalescer.timeout())
+            except (OSError, ValueError) as e:
+                if not self.stop:
+                    print(f"Select error: {e}")
+                break
+            for key, _ in events:
+                key.data(key.fileobj)
+            # 视频数据等待时间已到则立即回调，避免尾帧滞留
+            timeout = self.video_coalescer.timeout()
+            if timeout is not None and timeout <= 0:
+                self.video_coalescer.flush()
+        print("Select loop stopped")
+
+    def _drain_wakeup(self, sock):
         try:
-            self.video_socket.recv(1)
-            while not self.stop:
-                try:
-                    data = self.video_socket.recv(20480)
-                    if not data:
-                        break
-                    self.video_callback(data)
-                except (OSError, ConnectionError, socket.error) as e:
-                    if not self.stop:
-                        print(f"Video socket error: {e}")
-                    break
-        except (OSError, ConnectionError, socket.error) as e:
-            if not self.stop:
-                print(f"Video socket initialization error: {e}")
-        print("Video data reception stopped")
+            sock.recv(64)
+        except OSError:
+            pass
 
-    def receive_audio_data(self):
-        print("Receiving audio data...")
+    def _close_stream(self, sock, name):
+        """连接关闭或出错时从 selector 注销"""
         try:
-            self.audio_socket.recv(1)
-            while not self.stop:
-                try:
-                    data = self.audio_socket.recv(1024)
-                    if not data:
-                        break
-                except (OSError, ConnectionError, socket.error) as e:
-                    if not self.stop:
-                        print(f"Audio socket error: {e}")
-                    break
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        print(f"{name} data reception stopped")
+
+    def _recv_ready(self, sock, name, size):
+        """从可读的套接字读取数据；连接关闭或出错时注销并返回 None"""
+        try:
+            data = sock.recv(size)
+        except BlockingIOError:
+            return b''
         except (OSError, ConnectionError, socket.error) as e:
             if not self.stop:
-                print(f"Audio socket initialization error: {e}")
-        print("Audio data reception stopped")
+                print(f"{name} socket error: {e}")
+            data = None
+        if not data:
+            self._close_stream(sock, name)
+            return None
+        return data
 
-    def handle_control_conn(self):
-        print("Control connection established (idle)...")
+    def receive_video_data(self, sock):
         try:
-            self.control_socket.recv(1)
-            while not self.stop:
-                try:
-                    data = self.control_socket.recv(1024)
-                    if not data:
-                        break
-                    print("Control Mesg:", data)
-                except (OSError, ConnectionError, socket.error) as e:
-                    if not self.stop:
-                        print(f"Control socket error: {e}")
-                    break
+            if self.video_dummy_pending:
+                # tunnel_forward 模式下，第一个连接会先收到一个占位字节
+                n = len(sock.recv(1))
+                self.video_dummy_pending = not n
+            else:
+                # 将连续的小块数据按包边界聚合后再回调，减少下游 emit 与 WebSocket 帧数
+                n = self.video_coalescer.recv_into(sock)
+        except BlockingIOError:
+            return
         except (OSError, ConnectionError, socket.error) as e:
             if not self.stop:
-                print(f"Control socket initialization error: {e}")
-        print("Control connection stopped")
+                print(f"Video socket error: {e}")
+            n = 0
+        if not n:
+            self._close_stream(sock, "Video")
+
+    def handle_control_conn(self, sock):
+        data = self._recv_ready(sock, "Control", 1024)
+        if data and self.debug_control:
+            print(f"Control Mesg: {data!r}")
+
+    def _connect_socket(self):
+        if self.local_socket_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF_SIZE)
+            sock.connect(self.local_socket_path)
+            return sock
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # 接收缓冲区需在 connect 前设置才能影响 TCP 窗口
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF_SIZE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect(('localhost', self.local_port))
+        return sock
 
     def scrcpy_start(self, video_callback, video_bit_rate):
         self.video_bit_rate = video_bit_rate
         self.video_callback = video_callback
         self.stop = False
+        self.debug_control = log.isEnabledFor(logging.DEBUG)
 
-        # 检查设备连接状态
-        cmd = [self.adb_path]
+        # 检查设备连接状态：已知设备ID时直接查询其状态，无需列出全部设备
         if self.device_id:
-            cmd.extend(['-s', self.device_id])
-        cmd.append('devices')
-        
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if "device" not in result.stdout:
-            print(f"Device {self.device_id} not found or not authorized.")
-            return False
-        print(f"Device check result: {result.stdout}")
+            success, output = self.adb_manager._run_adb_command(['get-state'], self.device_id)
+            if not success or output.strip() != "device":
+                print(f"Device {self.device_id} not found or not authorized.")
+                return False
+        else:
+            success, output = self.adb_manager._run_adb_command(['devices'])
+            if "device" not in output:
+                print(f"Device {self.device_id} not found or not authorized.")
+                return False
+        print(f"Device check result: {output}")
 
         if not self.push_server_to_device():
             print("Failed to push server files to device.")
@@ -185,26 +364,25 @@ class Scrcpy:
 
         try:
             # video connection
-            self.video_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.video_socket.connect(('localhost', self.local_port))
+            self.video_socket = self._connect_socket()
             print("Video connection established")
 
-            # audio connection
-            self.audio_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.audio_socket.connect(('localhost', self.local_port))
-            print("Audio connection established")
-
             # contorl connection
-            self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.control_socket.connect(('localhost', self.local_port))
+            self.control_socket = self._connect_socket()
             print("Control connection established")
 
-            self.video_thread = Thread(target=self.receive_video_data, daemon=True)
-            self.audio_thread = Thread(target=self.receive_audio_data, daemon=True)
-            self.control_thread = Thread(target=self.handle_control_conn, daemon=True)
-            self.video_thread.start()
-            self.audio_thread.start()
-            self.control_thread.start()
+            # video 只在 select 就绪后读取，设为非阻塞；control 还需在其他线程发送，保持阻塞
+            self.video_socket.setblocking(False)
+            self.video_dummy_pending = True
+            self.video_coalescer = VideoCoalescer(self.video_callback)
+            self.selector = ReaderSelector()
+            self.wakeup_sockets = socket.socketpair()
+            self.selector.register(self.wakeup_sockets[0], selectors.EVENT_READ, self._drain_wakeup)
+            self.selector.register(self.video_socket, selectors.EVENT_READ, self.receive_video_data)
+            self.selector.register(self.control_socket, selectors.EVENT_READ, self.handle_control_conn)
+
+            self.select_thread = ReaderThread(target=self.select_loop, daemon=True)
+            self.select_thread.start()
             print("Background tasks started")
             
             return True  # 成功启动
@@ -217,11 +395,17 @@ class Scrcpy:
     def scrcpy_stop(self):
         print("Stopping Scrcpy")
         self.stop = True
+
+        # 先唤醒 select_loop，直接关闭已注册的套接字不一定能让 select 返回
+        if self.wakeup_sockets:
+            try:
+                self.wakeup_sockets[1].send(b'\0')
+            except OSError:
+                pass
         
         # 安全地关闭socket连接
         sockets_to_close = [
             ('video_socket', self.video_socket),
-            ('audio_socket', self.audio_socket),
             ('control_socket', self.control_socket)
         ]
         
@@ -238,19 +422,32 @@ class Scrcpy:
 
         # 等待线程结束
         threads_to_join = [
-            ('video_thread', self.video_thread),
-            ('audio_thread', self.audio_thread),
-            ('control_thread', self.control_thread)
+            ('select_thread', self.select_thread)
         ]
         
         for thread_name, thread in threads_to_join:
             if thread and thread.is_alive():
                 try:
-                    thread.join(timeout=3)
+                    join_reader_thread(thread, timeout=3)
                     if thread.is_alive():
                         print(f"Warning: {thread_name} did not stop within timeout")
                 except Exception as e:
                     print(f"Error joining {thread_name}: {e}")
+
+        if self.select_thread and self.select_thread.is_alive():
+            # 读取线程仍在运行时不能关闭它正在使用的 selector/唤醒套接字，留给垃圾回收
+            self.selector = None
+            self.wakeup_sockets = None
+        if self.selector:
+            try:
+                self.selector.close()
+            except Exception:
+                pass
+            self.selector = None
+        if self.wakeup_sockets:
+            for sock in self.wakeup_sockets:
+                sock.close()
+            self.wakeup_sockets = None
             
         # 终止Android进程
         if self.android_process:
@@ -281,25 +478,29 @@ class Scrcpy:
         
         print("Scrcpy stopped")
 
+    def scrcpy_reset_video(self):
+        """请求设备重新开始编码，尽快产生新的关键帧"""
+        return self.scrcpy_send_control(bytes([CONTROL_MSG_TYPE_RESET_VIDEO]))
+
     def scrcpy_send_control(self, data):
         try:
             if not hasattr(self, 'control_socket') or self.control_socket is None:
-                print("Error: Control socket not initialized")
+                log.warning("Control socket not initialized")
                 return False
             
             # 检查套接字是否仍然连接
             try:
                 # 尝试发送数据
                 self.control_socket.send(data)
-                print(f"Control data sent successfully: {len(data)} bytes")
+                log.debug("Control data sent successfully: %d bytes", len(data))
                 return True
             except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
-                print(f"Control socket connection lost: {e}")
+                log.warning("Control socket connection lost: %s", e)
                 return False
             except Exception as e:
-                print(f"Error sending control data: {e}")
+                log.warning("Error sending control data: %s", e)
                 return False
                 
         except Exception as e:
-            print(f"Unexpected error in scrcpy_send_control: {e}")
+            log.warning("Unexpected error in scrcpy_send_control: %s", e)
             return False
\ No newline at end of file